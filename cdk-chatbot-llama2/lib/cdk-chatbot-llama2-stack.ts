@@ -113,7 +113,8 @@ export class CdkChatbotLlama2Stack extends cdk.Stack {
     if(rag_type == "opensearch") {
       // OpenSearch
       const domain = new opensearch.Domain(this, 'Domain', {
-        version: opensearch.EngineVersion.OPENSEARCH_2_3,
+        version: opensearch.EngineVersion.openSearch('2.7'), // filtering in k-NN search of lucene
+        enableVersionUpgrade: true, // upgrade the existing domain in place instead of replacing it
         
         domainName: domainName,
         removalPolicy: cdk.RemovalPolicy.DESTROY,
@@ -214,7 +215,7 @@ export class CdkChatbotLlama2Stack extends cdk.Stack {
       }
     });     
     lambdaChatApi.grantInvoke(new iam.ServicePrincipal('apigateway.amazonaws.com'));  
-    s3Bucket.grantRead(lambdaChatApi); // permission for s3
+    s3Bucket.grantReadWrite(lambdaChatApi); // permission for s3 (documents and chunk manifests)
     callLogDataTable.grantReadWriteData(lambdaChatApi); // permission for dynamo
     
     const SageMakerPolicy = new iam.PolicyStatement({  // policy statement for sagemaker
@@ -0,0 +1,42 @@
+import time
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from lambda_function import split_text
+
+def load_contents(size):
+    paragraph = (
+        "Amazon SageMaker JumpStart provides pretrained models for a wide range of problem types. "
+        "You can deploy Llama 2 with a few clicks and call it from a lambda function.\n"
+        "이 문서는 chunker의 성능을 측정하기 위한 예제입니다. 한국어 문장도 함께 포함합니다\n"
+        "Vector store를 이용하면 문서의 내용을 검색할 수 있습니다. 문장의 경계를 유지하는 것이 중요하다\n\n"
+    )
+    return paragraph * (size // len(paragraph) + 1)
+
+def split_by_recursive_splitter(contents):
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=100,
+        separators=["\n\n", "\n", ".", " ", ""],
+        length_function = len,
+    )
+    return text_splitter.split_text(str(contents).replace("\n"," "))
+
+def split_by_offsets(contents):
+    return split_text(contents, chunk_size=1000, chunk_overlap=100)
+
+def measure(name, splitter, contents):
+    start = time.time()
+    texts = splitter(contents)
+    elapsed = time.time()-start
+
+    print(f'{name}: {len(texts)} chunks, {elapsed:0.3f}s, {len(contents)/elapsed/1024/1024:0.2f} MB/s')
+
+def main():
+    for size in [1, 4, 16]:  # MB
+        contents = load_contents(size*1024*1024)
+        print(f'size: {size}MB')
+
+        measure('RecursiveCharacterTextSplitter', split_by_recursive_splitter, contents)
+        measure('split_text', split_by_offsets, contents)
+
+if __name__ == '__main__':
+    main()
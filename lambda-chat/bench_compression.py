@@ -0,0 +1,50 @@
+import sys
+import time
+from langchain.docstore.document import Document
+from lambda_function import llm, split_text, compress_documents, estimate_tokens, maxContextTokens, HUMAN_PROMPT, AI_PROMPT
+
+def load_documents():
+    contents = (
+        "Amazon SageMaker JumpStart provides pretrained models for a wide range of problem types. "
+        "You can deploy Llama 2 with a few clicks and call it from a lambda function. "
+        "The endpoint is billed per instance hour while it is running.\n"
+        "Lambda is a serverless compute service. Pricing depends on the number of requests and the duration. "
+        "The duration is rounded up to the nearest millisecond and depends on the memory size.\n"
+        "람다는 서버리스 컴퓨팅 서비스입니다. 가격은 요청 수와 실행 시간에 따라 달라집니다. "
+        "메모리 크기를 늘리면 CPU도 함께 늘어납니다\n\n"
+    ) * 10
+    texts = split_text(contents, chunk_size=1000, chunk_overlap=100)
+
+    return [Document(page_content=t, metadata={'name': 'sample.txt', 'page': i+1}) for i, t in enumerate(texts[:3])]
+
+def get_prompt(query, docs):
+    context = '\n'.join(doc.page_content for doc in docs)
+    return f"{HUMAN_PROMPT} {context}\n\nQuestion: {query}{AI_PROMPT}"
+
+def main():
+    use_llm = '--llm' in sys.argv  # measure the latency of the endpoint as well
+    queries = [
+        "How is the lambda priced?",
+        "How can I deploy Llama 2?",
+        "람다의 가격은 어떻게 결정되나요?",
+    ]
+    docs = load_documents()
+
+    for query in queries:
+        start = time.time()
+        compressed = compress_documents(query, docs, maxContextTokens)
+        elapsed = time.time()-start
+
+        original_tokens = estimate_tokens(get_prompt(query, docs))
+        compressed_tokens = estimate_tokens(get_prompt(query, compressed))
+        print(f'query: {query}')
+        print(f'prompt tokens: {original_tokens} -> {compressed_tokens} ({100*(1-compressed_tokens/original_tokens):0.1f}% reduced), compression: {elapsed*1000:0.1f}ms')
+
+        if use_llm:
+            for name, prompt_docs in [('original', docs), ('compressed', compressed)]:
+                start = time.time()
+                llm(get_prompt(query, prompt_docs))
+                print(f'{name} latency: {time.time()-start:0.2f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import json
+import random
+import time
+import numpy as np
+from io import BytesIO
+from botocore.exceptions import ClientError
+from lambda_function import ResilientClient, set_deadline, invocation_stats
+
+class FaultInjectingClient:
+    # local stub of sagemaker-runtime with slow responses and throttling
+    def __init__(self, latency=0.05, slow_rate=0.03, slow_latency=2.0, error_rate=0.05):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+
+    def invoke_endpoint(self, **kwargs):
+        if random.random() < self.error_rate:
+            raise ClientError(
+                {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}, 'ResponseMetadata': {'HTTPStatusCode': 400}},
+                'InvokeEndpoint'
+            )
+        time.sleep(self.slow_latency if random.random() < self.slow_rate else self.latency)
+
+        return {
+            'Body': BytesIO(json.dumps({"embedding": [[0.1, 0.2, 0.3]]}).encode('utf-8'))
+        }
+
+def run(name, client, requests):
+    latencies = []
+    errors = 0
+    for i in range(requests):
+        set_deadline(None)
+        start = time.time()
+        try:
+            response = client.invoke_endpoint(EndpointName='stub', Body=b'{}')
+            json.loads(response['Body'].read().decode('utf-8'))
+        except Exception as e:
+            errors += 1
+        latencies.append(time.time()-start)
+
+    print(f'{name}: errors: {errors}, p50: {np.percentile(latencies, 50):0.3f}s, p99: {np.percentile(latencies, 99):0.3f}s, max: {max(latencies):0.3f}s')
+
+def main():
+    random.seed(0)
+    run('direct', FaultInjectingClient(error_rate=0), 200)
+
+    random.seed(0)
+    run('resilient', ResilientClient(FaultInjectingClient(), hedge=True, min_timeout=1.0), 200)
+    print('invocation_stats: ', invocation_stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import random
+import time
+import tracemalloc
+from lambda_function import LexicalIndex
+
+words = [
+    "lambda", "sagemaker", "endpoint", "opensearch", "faiss", "vector", "embedding", "document",
+    "latency", "throughput", "error", "timeout", "product", "code", "field", "value",
+    "람다", "서버리스", "문서", "검색", "임베딩", "응답", "시간", "오류",
+]
+
+def load_texts(count):
+    texts = []
+    for i in range(count):
+        body = ' '.join(random.choice(words) for _ in range(150))
+        texts.append(f"{body} E-{i:06d}")  # a unique code per chunk
+    return texts
+
+def main():
+    random.seed(0)
+    for count in [1000, 10000, 50000]:
+        texts = load_texts(count)
+
+        tracemalloc.start()
+        start = time.time()
+        index = LexicalIndex()
+        index.add([str(i) for i in range(count)], texts)
+        elapsed = time.time()-start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        queries = [f"E-{random.randrange(count):06d}" for _ in range(50)] + ["lambda timeout error"]*50
+        start = time.time()
+        for query in queries:
+            index.search(query, 12)
+        latency = (time.time()-start)/len(queries)
+
+        print(f'chunks: {count}, build: {elapsed:0.2f}s, memory: {memory/1024/1024:0.1f}MB, query: {latency*1000:0.2f}ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+import numpy as np
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+stub = '--stub' in sys.argv
+if stub:  # faiss in memory, and the documents in the stub of s3
+    os.environ.setdefault('rag_type', 'faiss')
+    os.environ.setdefault('s3_prefix', 'docs')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function
+from server import PooledHTTPServer, ChatRequestHandler
+
+sample = (
+    "Lambda is a serverless compute service. Pricing depends on the number of requests and the duration. "
+    "The duration is rounded up to the nearest millisecond and depends on the memory size.\n"
+    "SageMaker JumpStart provides pretrained models. You can deploy Llama 2 with a few clicks.\n\n"
+) * 20
+
+class StubSageMaker:
+    # the latency of the endpoints with fake embeddings and answers
+    def __init__(self, llm_latency=0.05, embedding_latency=0.01, dimension=64):
+        self.llm_latency = llm_latency
+        self.embedding_latency = embedding_latency
+        self.dimension = dimension
+
+    def embed(self, text):
+        seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+        return np.random.RandomState(seed).rand(self.dimension).tolist()
+
+    def invoke_endpoint(self, **kwargs):
+        body = json.loads(kwargs['Body'])
+        if 'text_inputs' in body:
+            time.sleep(self.embedding_latency)
+            result = {"embedding": [self.embed(text) for text in body['text_inputs']]}
+        else:
+            time.sleep(self.llm_latency)
+            result = [{"generation": {"content": "stub answer"}}]
+        return {'Body': BytesIO(json.dumps(result).encode('utf-8'))}
+
+class NoSuchKey(Exception):
+    pass
+
+class StubS3:
+    # objects in memory
+    exceptions = types.SimpleNamespace(NoSuchKey=NoSuchKey)
+
+    def __init__(self):
+        self.objects = {'docs/sample.txt': sample.encode('utf-8')}
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            if Key not in self.objects:
+                raise NoSuchKey(Key)
+            return {'Body': BytesIO(self.objects[Key]), 'ETag': hashlib.md5(self.objects[Key]).hexdigest()}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            self.objects[Key] = Body
+        return {}
+
+    def upload_file(self, file_name, bucket, key):
+        with open(file_name, 'rb') as f:
+            self.put_object(bucket, key, f.read())
+
+    def download_file(self, bucket, key, file_name):
+        with open(file_name, 'wb') as f:
+            f.write(self.get_object(bucket, key)['Body'].read())
+
+class StubDynamoDB:
+    def put_item(self, **kwargs):
+        return {}
+
+    def query(self, **kwargs):
+        return {'Items': []}
+
+def use_stub():
+    # serve with the real handler, where only the clients of sagemaker, s3 and dynamodb are stubs
+    sagemaker = StubSageMaker()
+    lambda_function.llm.client = lambda_function.ResilientClient(sagemaker, hedge=False, adaptive=False)
+    lambda_function.embeddings.client = lambda_function.ResilientClient(sagemaker, hedge=True, min_timeout=2.0)
+    lambda_function.s3 = StubS3()
+    lambda_function.dynamodb_client = StubDynamoDB()
+
+def load_event(n):
+    userId = f"load-test-{n%16}"
+    if n < 16:  # each user uploads a document first
+        type, body = "document", "sample.txt"
+    else:
+        type, body = "text", "How is the lambda priced?"
+    json_data = {
+        "user_id": userId,
+        "request_id": f"load-test-request-{n}",
+        "request_time": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "type": type,
+        "body": body
+    }
+    return json_data
+
+def send(url, n):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(load_event(n)).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def run(workers, requests, concurrency):
+    server = PooledHTTPServer(('127.0.0.1', 0), ChatRequestHandler, workers)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/chat'
+
+    for n in range(16):  # uploads, which are not measured
+        send(url, n)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(lambda n: send(url, n), range(16, 16+requests)))
+    elapsed = time.time()-start
+
+    server.shutdown()
+    server.server_close()
+
+    errors = len([status for status in statuses if status != 200])
+    print(f'workers: {workers}, requests: {requests}, errors: {errors}, elapsed: {elapsed:0.2f}s, throughput: {requests/elapsed:0.2f} req/s')
+
+def main():
+    if stub:
+        use_stub()
+
+    for workers in [1, 2, 4, 8, 16]:
+        run(workers, requests=64, concurrency=16)
+
+if __name__ == '__main__':
+    main()
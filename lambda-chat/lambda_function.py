@@ -8,6 +8,17 @@ import PyPDF2
 import csv
 import sys
 import re
+import hashlib
+import numpy as np
+import threading
+import random
+import collections
+import math
+import shutil
+import copy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 
 from langchain import PromptTemplate, SagemakerEndpoint
 from langchain.llms.sagemaker_endpoint import LLMContentHandler
@@ -19,13 +30,18 @@ from langchain.vectorstores import FAISS
 from langchain.vectorstores import OpenSearchVectorSearch
 from langchain.document_loaders import CSVLoader
 from langchain.indexes.vectorstore import VectorStoreIndexWrapper
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain.prompts import PromptTemplate
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from langchain.chains import ConversationalRetrievalChain
 from langchain.memory import ConversationBufferMemory
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
 
 s3 = boto3.client('s3')
+dynamodb_client = boto3.client('dynamodb')
 s3_bucket = os.environ.get('s3_bucket') # bucket name
 s3_prefix = os.environ.get('s3_prefix')
 callLogTableName = os.environ.get('callLogTableName')
@@ -33,7 +49,8 @@ opensearch_url = os.environ.get('opensearch_url')
 rag_type = os.environ.get('rag_type')
 opensearch_account = os.environ.get('opensearch_account')
 opensearch_passwd = os.environ.get('opensearch_passwd')
-isReady = False   
+manifest_prefix = os.environ.get('manifest_prefix', 'manifest')
+faiss_prefix = os.environ.get('faiss_prefix', 'faiss')
 endpoint_llm = os.environ.get('endpoint_llm')
 endpoint_embedding = os.environ.get('endpoint_embedding')
 
@@ -41,9 +58,26 @@ enableConversationMode = os.environ.get('enableConversationMode', 'enabled')
 print('enableConversationMode: ', enableConversationMode)
 enableReference = os.environ.get('enableReference', 'false')
 enableRAG = os.environ.get('enableRAG', 'true')
+enableCompression = os.environ.get('enableCompression', 'true')
 
 methodOfConversation = 'PromptTemplate' # ConversationalRetrievalChain or PromptTemplate
 typeOfHistoryTemplate = 'Basic' # Llam2 or Basic
+maxContextTokens = 600 # token budget of the relevant documents after compression
+minQueryCoverage = 0.5 # fraction of the query terms which the documents need to contain to be compressed
+searchType = 'mmr' # mmr or similarity
+fetchK = 12 # number of candidates to rerank
+lambdaMult = 0.5 # 1 for relevance only, 0 for diversity only
+minRelevanceScore = 0.2 # minimum cosine similarity to the query
+enableHybridSearch = True # fuse bm25 and dense search for faiss
+lexicalMargin = 2.0 # skip the dense search when the best bm25 score is this times the second
+rrfK = 60 # constant of reciprocal rank fusion
+minLexicalMatch = 0.5 # fraction of the query terms which a lexical hit needs to join the fusion
+lexicalWeight = 0.5 # weight of the lexical ranking in the fusion, where the dense ranking is 1
+efSearch = int(os.environ.get('ef_search', '100')) # candidates of the k-NN search in opensearch
+maxAttempts = 3 # attempts to invoke an endpoint
+hedgePercentile = 95 # send a duplicated embedding request when a call is slower than this percentile
+deadlineMargin = 3 # seconds reserved to store the call log after the answer
+defaultTimeout = 60 # seconds for a request without lambda context
 
 # Prompt Template
 HUMAN_PROMPT = "\n\nUser:"
@@ -94,9 +128,228 @@ class ContentHandler(LLMContentHandler):
         response_json = json.loads(output.read().decode("utf-8"))
         return response_json[0]["generation"]["content"]
 
+# deadline of the request which is being served by the current thread
+request_context = threading.local()
+
+def set_deadline(context):
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining = context.get_remaining_time_in_millis()/1000
+    else:
+        remaining = defaultTimeout
+    request_context.deadline = time.time() + remaining - deadlineMargin
+
+def get_remaining_time():
+    deadline = getattr(request_context, 'deadline', None)
+    if deadline is None:
+        return defaultTimeout
+    return deadline - time.time()
+
+def get_positive_int(value, default):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+def get_search_filter(value):
+    # invalid values are ignored, so that the request is answered without the filter
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            print('invalid filter: ', value)
+            return {}
+    if not isinstance(value, dict):
+        return {}
+    return {key: value[key] for key in ('name', 'type', 'after', 'before') if isinstance(value.get(key), str) and value[key]}
+
+def set_search_options(event):
+    # optional filter of {name, type, after, before} and k/ef_search of the request
+    options = {
+        'user_id': event.get('user_id'),
+        'filter': get_search_filter(event.get('filter')),
+        'k': get_positive_int(event.get('k'), None),
+        'ef_search': get_positive_int(event.get('ef_search'), efSearch),
+    }
+    print('search options: ', options)
+    request_context.search_options = options
+
+def get_search_options():
+    return getattr(request_context, 'search_options', {'user_id': None, 'filter': {}, 'k': None, 'ef_search': efSearch})
+
+invocation_stats = {
+    'calls': 0,
+    'retries': 0,
+    'hedges': 0,
+    'hedge_wins': 0,
+    'timeouts': 0,
+    'failures': 0,
+}
+
+def count_invocation(key):
+    with stats_lock:
+        invocation_stats[key] += 1
+
+def is_retryable(error, retry_timeout=True):
+    if isinstance(error, BotoConnectionError):  # not sent yet
+        return True
+    if isinstance(error, (TimeoutError, HTTPClientError)):  # may be still running in the endpoint
+        return retry_timeout
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in ('ThrottlingException', 'ServiceUnavailable', 'InternalFailure', 'ModelNotReadyException') or status == 429 or status >= 500
+    return False
+
+class ResilientClient:
+    # wraps invoke_endpoint of a sagemaker-runtime client with retries, deadlines and hedged requests
+    # adaptive=False bounds a call only by the deadline and doesn't retry timeouts, for the generation whose latency depends on the length
+    # batches of embeddings are not adaptive either, since the latency window is learned from single queries
+    # create_client(read_timeout) makes the clients whose read timeout follows the timeout of the call, so abandoned calls don't hold the workers
+    def __init__(self, client, hedge=False, adaptive=True, min_timeout=1.0, base_delay=0.2, max_delay=2.0, workers=16, create_client=None):
+        self.client = client
+        self.hedge = hedge
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latencies = collections.deque(maxlen=200)
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.inflight = 0
+        self.create_client = create_client
+        self.clients = dict()  # read timeout -> client
+
+    def get_client(self, timeout):
+        if self.create_client is None:
+            return self.client
+        read_timeout = min(2**math.ceil(math.log2(max(timeout, 1))), defaultTimeout)  # at most twice of the timeout
+        with self.lock:
+            if read_timeout not in self.clients:
+                self.clients[read_timeout] = self.create_client(read_timeout)
+            return self.clients[read_timeout]
+
+    def submit(self, client, kwargs, adaptive):
+        with self.lock:
+            self.inflight += 1
+        future = self.executor.submit(self.invoke, client, kwargs, adaptive)
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        with self.lock:
+            self.inflight -= 1
+
+    def is_saturated(self):
+        # calls which are timed out are still running, so don't add hedged requests
+        with self.lock:
+            return self.inflight >= self.workers // 2
+
+    def get_percentile(self, percentile):
+        with self.lock:
+            if len(self.latencies) < 20:  # not enough to estimate
+                return None
+            return float(np.percentile(self.latencies, percentile))
+
+    def invoke(self, client, kwargs, adaptive):
+        start = time.time()
+        response = client.invoke_endpoint(**kwargs)
+        response['Body'] = BytesIO(response['Body'].read())  # the timeout includes reading the body
+        if adaptive:
+            with self.lock:
+                self.latencies.append(time.time()-start)
+        return response
+
+    def call(self, kwargs, timeout, adaptive):
+        start = time.time()
+        client = self.get_client(timeout)
+        first = self.submit(client, kwargs, adaptive)
+        pending = {first}
+        hedge_delay = self.get_percentile(hedgePercentile) if self.hedge and adaptive else None
+        hedged = False
+        error = None
+
+        while pending:
+            elapsed = time.time()-start
+            if elapsed >= timeout:
+                break
+            wait_time = timeout - elapsed
+            if hedge_delay is not None and not hedged:
+                wait_time = min(wait_time, max(hedge_delay - elapsed, 0))
+
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        count_invocation('hedge_wins')
+                    return future.result()
+                error = future.exception()
+
+            if hedge_delay is not None and not hedged and pending and time.time()-start >= hedge_delay:
+                hedged = True
+                if self.is_saturated():
+                    print('skip hedging since the workers are busy')
+                    continue
+                count_invocation('hedges')
+                print(f'hedge a request after {hedge_delay:0.2f}s')
+                pending.add(self.submit(client, kwargs, adaptive))
+
+        if error is not None and not pending:
+            raise error
+        count_invocation('timeouts')
+        raise TimeoutError(f'no response from {kwargs.get("EndpointName")} in {timeout:0.2f}s')
+
+    def is_adaptive(self, kwargs):
+        if not self.adaptive:
+            return False
+        try:
+            body = json.loads(kwargs.get('Body') or '{}')
+        except ValueError:
+            return True
+        return not isinstance(body, dict) or len(body.get('text_inputs', [])) <= 1
+
+    def invoke_endpoint(self, **kwargs):
+        adaptive = self.is_adaptive(kwargs)
+        for attempt in range(maxAttempts):
+            remaining = get_remaining_time()
+            if remaining <= 0:
+                break
+
+            # adaptive timeout from the tail latency, within the deadline of the request
+            timeout = remaining
+            p99 = self.get_percentile(99) if adaptive else None
+            if p99 is not None:
+                timeout = min(remaining, max(self.min_timeout, 3*p99))
+
+            count_invocation('calls')
+            try:
+                return self.call(kwargs, timeout, adaptive)
+            except Exception as e:
+                if not is_retryable(e, retry_timeout=adaptive) or attempt == maxAttempts-1:
+                    count_invocation('failures')
+                    raise
+
+                delay = random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))  # full jitter
+                if delay >= get_remaining_time():
+                    count_invocation('failures')
+                    raise
+                count_invocation('retries')
+                print(f'retry {attempt+1} after {delay:0.2f}s: {e}')
+                time.sleep(delay)
+
+        count_invocation('failures')
+        raise TimeoutError('deadline of the request is exceeded')
+
 content_handler = ContentHandler()
 aws_region = boto3.Session().region_name
-client = boto3.client("sagemaker-runtime")
+def create_sagemaker_client(read_timeout):
+    return boto3.client(  # retries are done by ResilientClient
+        "sagemaker-runtime", 
+        region_name = aws_region, 
+        config = Config(read_timeout=read_timeout, retries={'total_max_attempts': 1})
+    )
+client = create_sagemaker_client(defaultTimeout)
 parameters = {
     "max_new_tokens": 1024, 
     "top_p": 0.9, 
@@ -110,8 +363,86 @@ llm = SagemakerEndpoint(
     endpoint_kwargs={"CustomAttributes": "accept_eula=true"},
     content_handler = content_handler
 )
+llm.client = ResilientClient(client, hedge=False, adaptive=False, create_client=create_sagemaker_client)
 
 map = dict()  # Conversation
+manifests = dict()  # chunk manifest per user: {file name: {'type', 'upload_time', 'chunks': {chunk id: index name}}}
+configs = dict()  # debug settings per user
+vectorstores = dict()  # faiss per user, None if the user has no documents
+unsaved = set()  # users whose faiss failed to be saved in s3
+chains = dict()  # ConversationalRetrievalChain per user
+locks = dict()  # requests of a user are served in order
+last_access = collections.OrderedDict()  # userId -> last access time, the least recent first
+lock = threading.Lock()  # for the maps of users
+stats_lock = threading.Lock()
+maxUsers = int(os.environ.get('max_users', '1000')) # users whose states are kept in memory
+userIdleTime = int(os.environ.get('user_idle_time', '3600')) # seconds to keep the states of an idle user
+
+def get_lock(userId):
+    with lock:
+        if userId not in locks:
+            locks[userId] = threading.RLock()
+        return locks[userId]
+
+def acquire_lock(userId):
+    # retry if the user was evicted while waiting for the lock
+    while True:
+        user_lock = get_lock(userId)
+        user_lock.acquire()
+        with lock:
+            if locks.get(userId) is user_lock:
+                last_access[userId] = time.time()
+                last_access.move_to_end(userId)
+                return user_lock
+        user_lock.release()
+
+def evict_users():
+    # remove the states of the least recently used users over maxUsers, and of idle users
+    now = time.time()
+    with lock:
+        candidates = []
+        for userId, accessed in last_access.items():
+            if len(last_access) - len(candidates) <= maxUsers and now - accessed < userIdleTime:
+                break
+            candidates.append((userId, accessed))
+
+    for userId, accessed in candidates:
+        with lock:
+            user_lock = locks.get(userId)
+        if user_lock is None or not user_lock.acquire(blocking=False):  # already evicted or being served
+            continue
+        try:
+            with lock:
+                if locks.get(userId) is not user_lock or last_access.get(userId) != accessed:  # evicted or accessed again
+                    continue
+            if userId in unsaved and not save_faiss(userId):  # faiss is the only copy of the documents
+                continue
+            with lock:
+                for states in (map, configs, vectorstores, chains, manifests, last_access, locks):
+                    states.pop(userId, None)
+            print('evicted: ', userId)
+        finally:
+            user_lock.release()
+
+def get_config(userId):
+    with lock:
+        if userId not in configs:
+            configs[userId] = {
+                'enableConversationMode': enableConversationMode,
+                'enableReference': enableReference,
+                'enableRAG': enableRAG,
+                'enableCompression': enableCompression,
+            }
+        return configs[userId]
+
+def get_chat_memory(userId):
+    with lock:
+        if userId in map:
+            print('chat_memory exist. reuse it!')
+        else: 
+            map[userId] = ConversationBufferMemory(human_prefix='User', ai_prefix='Assistant')
+            print('chat_memory does not exist. create new one!')
+        return map[userId]
 
 # embedding
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
@@ -134,14 +465,14 @@ embeddings = SagemakerEndpointEmbeddings(
     region_name = aws_region,
     content_handler = content_handler2,
 )
+embeddings.client = ResilientClient(client, hedge=True, min_timeout=2.0, create_client=create_sagemaker_client)
 
 # load documents from s3 for pdf and txt
 def load_document(file_type, s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
+    doc = s3.get_object(Bucket=s3_bucket, Key=s3_prefix+'/'+s3_file_name)
     
     if file_type == 'pdf':
-        contents = doc.get()['Body'].read()
+        contents = doc['Body'].read()
         reader = PyPDF2.PdfReader(BytesIO(contents))
         
         raw_text = []
@@ -150,30 +481,533 @@ def load_document(file_type, s3_file_name):
         contents = '\n'.join(raw_text)    
         
     elif file_type == 'txt':        
-        contents = doc.get()['Body'].read().decode('utf-8')
+        contents = doc['Body'].read().decode('utf-8')
         
     print('contents: ', contents)
-    new_contents = str(contents).replace("\n"," ") 
-    print('length: ', len(new_contents))
+    print('length: ', len(contents))
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100,
-        separators=["\n\n", "\n", ".", " ", ""],
-        length_function = len,
-    ) 
-
-    texts = text_splitter.split_text(new_contents) 
+    texts = split_text(contents, chunk_size=1000, chunk_overlap=100)
     print('texts[0]: ', texts[0])
     
     return texts
 
+# sentence end: punctuation followed by a space, or korean final ending at the end of a line
+pattern_sentence = re.compile('[.!?\u3002\uff1f\uff01\u2026]+[\'"\u201d\u2019)\\]]*(?=\\s)|(?:\ub2e4|\uc694|\uc8e0|\uae4c)(?=[ \\t]*\\n)')
+
+def find_break(text, lo, hi):
+    # find the last separator in text[lo:hi] without copying, in the order of paragraph, sentence, line and word
+    pos = text.rfind('\n\n', lo, hi)
+    if pos >= 0:
+        return pos+2
+
+    last = None
+    for last in pattern_sentence.finditer(text, lo, hi):
+        pass
+    if last is not None:
+        return last.end()
+
+    for sep in ('\n', ' '):
+        pos = text.rfind(sep, lo, hi)
+        if pos >= 0:
+            return pos+1
+    
+    return hi
+
+def get_chunk_offsets(text, chunk_size=1000, chunk_overlap=100):
+    offsets = []
+    length = len(text)
+
+    start = 0
+    while start < length and text[start].isspace():
+        start += 1
+
+    while start < length:
+        end = start + chunk_size
+        if end >= length:
+            end = length
+        else:  # don't make a chunk smaller than a half
+            end = find_break(text, start + chunk_size//2, end)
+
+        # trim trailing white spaces
+        stop = end
+        while stop > start and text[stop-1].isspace():
+            stop -= 1
+        if stop > start:
+            offsets.append((start, stop))
+        if end >= length:
+            break
+
+        # overlap from the first word boundary within the overlap
+        next = max(end - chunk_overlap, start + 1)
+        if next < end:
+            pos = text.find(' ', next, end)
+            if pos >= 0:
+                next = pos + 1
+        while next < length and text[next].isspace():
+            next += 1
+        start = next
+
+    return offsets
+
+def split_text(text, chunk_size=1000, chunk_overlap=100):
+    return [text[start:end] for start, end in get_chunk_offsets(text, chunk_size, chunk_overlap)]
+
+def split_sentences(text):
+    sentences = []
+    start = 0
+    for m in pattern_sentence.finditer(text):
+        sentences.extend(line for line in text[start:m.end()].split('\n') if line.strip())
+        start = m.end()
+    sentences.extend(line for line in text[start:].split('\n') if line.strip())
+
+    return [sentence.strip() for sentence in sentences]
+
+pattern_hangul_char = re.compile('[\u3131-\u3163\uac00-\ud7a3]')
+pattern_term = re.compile(r'[^\W_]+')
+
+def estimate_tokens(text):
+    # hangul is about a token per character, and the others are about four characters per token
+    hangul = len(pattern_hangul_char.findall(text))
+    return hangul + (len(text)-hangul)//4 + 1
+
+def get_tokens(text):
+    # words, and bigrams of hangul words since korean attaches postpositions to the words
+    tokens = []
+    for word in pattern_term.findall(text.lower()):
+        if pattern_hangul_char.match(word) and len(word) > 2:
+            tokens.extend(word[i:i+2] for i in range(len(word)-1))
+        else:
+            tokens.append(word)
+    return tokens
+
+def get_terms(text):
+    return set(get_tokens(text))
+
+# function words which match almost any sentence
+stopwords = set("""
+a an the and or but if of to in on at by for with from as into about than then so not no
+is are was were be been being am do does did done have has had can could will would shall should may might must
+i me my we our you your he him his she her it its they them their this that these those there here
+what which who whom whose when where why how all any some each
+그 이 저 것 수 등 및 더 때 좀 잘
+""".split())
+
+def get_stem(term):
+    # strip a common english suffix, so that price, priced and pricing are matched
+    if len(term) > 4 and term.isascii():
+        for suffix in ('ing', 'ed', 'es', 's', 'e'):
+            if term.endswith(suffix) and len(term)-len(suffix) >= 3:
+                return term[:-len(suffix)]
+    return term
+
+compression_stats = {
+    'requests': 0,
+    'original_tokens': 0,
+    'compressed_tokens': 0,
+    'elapsed_time': 0.0,
+}
+
+def record_compression(original_tokens, compressed_tokens, start):
+    with stats_lock:
+        compression_stats['requests'] += 1
+        compression_stats['original_tokens'] += original_tokens
+        compression_stats['compressed_tokens'] += compressed_tokens
+        compression_stats['elapsed_time'] += time.time() - start
+
+def compress_documents(query, docs, max_tokens):
+    start = time.time()
+
+    sentences = []   # (document index, sentence)
+    for i, doc in enumerate(docs):
+        for sentence in split_sentences(doc.page_content):
+            sentences.append((i, sentence))
+    original_tokens = sum(estimate_tokens(doc.page_content) for doc in docs)
+
+    vocabulary = {stem: i for i, stem in enumerate(set(get_stem(term) for term in get_terms(query) - stopwords))}
+    if not sentences or not vocabulary:
+        record_compression(original_tokens, original_tokens, start)
+        return docs
+
+    # sentence-term matrix for the terms of the query
+    matrix = np.zeros((len(sentences), len(vocabulary)), dtype=np.float32)
+    lengths = np.ones(len(sentences), dtype=np.float32)
+    for row, (_, sentence) in enumerate(sentences):
+        terms = get_terms(sentence)
+        lengths[row] = max(len(terms), 1)
+        for term in terms:
+            column = vocabulary.get(get_stem(term))
+            if column is not None:
+                matrix[row, column] = 1
+
+    df = matrix.sum(axis=0)
+    coverage = np.count_nonzero(df) / len(vocabulary)
+    if coverage < minQueryCoverage:  # found by meaning, such as a paraphrase or another language
+        print(f'compression: skipped since {coverage:0.2f} of the query terms are in the documents')
+        record_compression(original_tokens, original_tokens, start)
+        return docs
+
+    idf = np.log((1 + len(sentences)) / (1 + df)) + 1
+    scores = (matrix @ idf) / np.sqrt(lengths)
+
+    # keep the best sentences within the budget, and the sentences without any term of the query are dropped
+    selected = set()
+    total = 0
+    for row in np.argsort(-scores, kind='stable'):
+        if selected and scores[row] == 0:
+            break
+        tokens = estimate_tokens(sentences[row][1])
+        if total + tokens > max_tokens:
+            if selected:
+                continue
+        selected.add(row)
+        total += tokens
+
+    if len(selected) == len(sentences):  # nothing to drop
+        record_compression(original_tokens, original_tokens, start)
+        return docs
+
+    compressed = []
+    for i, doc in enumerate(docs):
+        content = ' '.join(sentence for row, (index, sentence) in enumerate(sentences) if index == i and row in selected)
+        if content:
+            compressed.append(Document(page_content=content, metadata=doc.metadata))
+
+    compressed_tokens = sum(estimate_tokens(doc.page_content) for doc in compressed)
+    record_compression(original_tokens, compressed_tokens, start)
+    print(f'compression: {original_tokens} -> {compressed_tokens} tokens, {len(docs)} -> {len(compressed)} documents, {time.time()-start:0.3f}s')
+
+    return compressed
+
+class SentenceCompressor(BaseDocumentCompressor):
+    max_tokens: int = maxContextTokens
+
+    def compress_documents(self, documents, query, callbacks=None):
+        return compress_documents(query, documents, self.max_tokens)
+
+    async def acompress_documents(self, documents, query, callbacks=None):
+        return compress_documents(query, documents, self.max_tokens)
+
+class LexicalIndex:
+    # bm25 over an inverted index of {term: {document id: term frequency}}
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = dict()
+        self.lengths = dict()  # document id -> number of tokens
+        self.total_length = 0
+
+    def add(self, ids, texts):
+        for id, text in zip(ids, texts):
+            if id in self.lengths:
+                continue
+            tokens = get_tokens(text)
+            for term, count in collections.Counter(tokens).items():
+                self.postings.setdefault(term, dict())[id] = count
+            self.lengths[id] = len(tokens)
+            self.total_length += len(tokens)
+
+    def delete(self, ids, texts):
+        for id, text in zip(ids, texts):
+            if id not in self.lengths:
+                continue
+            for term in set(get_tokens(text)):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(id, None)
+                    if not postings:
+                        del self.postings[term]
+            self.total_length -= self.lengths.pop(id)
+
+    def search(self, query, k, allowed=None):
+        # returns [(document id, score, number of matched query terms)] in the order of score, only of the allowed ids if given
+        if not self.lengths:
+            return []
+        count = len(self.lengths)
+        average = self.total_length / count
+
+        scores = dict()
+        matches = dict()
+        for term in get_terms(query):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, tf in postings.items():
+                if allowed is not None and id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[id] / average)
+                scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                matches[id] = matches.get(id, 0) + 1
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(id, score, matches[id]) for id, score in best]
+
+    def to_dict(self):
+        return {'k1': self.k1, 'b': self.b, 'postings': self.postings, 'lengths': self.lengths}
+
+    @classmethod
+    def from_dict(cls, values):
+        index = cls(values['k1'], values['b'])
+        index.postings = values['postings']
+        index.lengths = values['lengths']
+        index.total_length = sum(index.lengths.values())
+        return index
+
+class HybridFAISS(FAISS):
+    # faiss which keeps a lexical index of the same documents
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lexical_index = LexicalIndex()
+
+    def rebuild_lexical_index(self):
+        self.lexical_index = LexicalIndex()
+        ids = list(self.index_to_docstore_id.values())
+        self.lexical_index.add(ids, [self.docstore.search(id).page_content for id in ids])
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        vectorstore = super().from_texts(texts, embedding, metadatas=metadatas, ids=ids, **kwargs)
+        vectorstore.rebuild_lexical_index()
+        return vectorstore
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = super().add_texts(texts, metadatas=metadatas, ids=ids, **kwargs)
+        self.lexical_index.add(ids, texts)
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        texts = [getattr(self.docstore.search(id), 'page_content', '') for id in ids]
+        result = super().delete(ids, **kwargs)
+        self.lexical_index.delete(ids, texts)
+        return result
+
+    def save_local(self, folder_path, index_name="index"):
+        super().save_local(folder_path, index_name)
+        with open(os.path.join(folder_path, index_name+'.lexical.json'), 'w') as f:
+            json.dump(self.lexical_index.to_dict(), f)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", **kwargs):
+        vectorstore = super().load_local(folder_path, embeddings, index_name, **kwargs)
+        path = os.path.join(folder_path, index_name+'.lexical.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                vectorstore.lexical_index = LexicalIndex.from_dict(json.load(f))
+        else:
+            vectorstore.rebuild_lexical_index()
+        return vectorstore
+
+def fuse_rankings(rankings, k, weights):
+    # weighted reciprocal rank fusion of the lists of documents
+    scores = dict()
+    docs = dict()
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc in enumerate(ranking):
+            key = doc.page_content  # chunks of a user are deduplicated by their contents
+            scores[key] = scores.get(key, 0.0) + weight/(rrfK + rank + 1)
+            docs.setdefault(key, doc)
+
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [docs[key] for key, _ in best]
+
+def match_file(name, entry, search_filter):
+    if search_filter.get('name') and name != search_filter['name']:
+        return False
+    if search_filter.get('type') and entry['type'] != search_filter['type']:
+        return False
+    # 'YYYY-MM-DD hh:mm:ss' is ordered as a string
+    if search_filter.get('after') and entry['upload_time'] < search_filter['after']:
+        return False
+    if search_filter.get('before') and entry['upload_time'] > search_filter['before']:
+        return False
+    return True
+
+def get_filter_ids(options):
+    # chunks are shared by the files of a user and are not indexed again, so the filter is resolved by the files in the manifest
+    search_filter = options['filter']
+    if not search_filter:
+        return None
+    if 'filter_ids' not in options:  # once per request
+        manifest, _ = load_manifest(options['user_id'])
+        ids = set()
+        for name, entry in manifest.items():
+            if match_file(name, entry, search_filter):
+                ids.update(entry['chunks'].keys())
+        options['filter_ids'] = list(ids)
+        print(f'filter: {len(ids)} chunks')
+    return options['filter_ids']
+
+def get_allowed_ids(vectorstore, options):
+    # ids of the documents in faiss which match the filter
+    return set(id for id in get_filter_ids(options) if id in vectorstore.docstore._dict)
+
+def search_lexical(query, vectorstore, k, allowed):
+    # returns (documents, whether the best match is clear enough to skip the dense search)
+    results = vectorstore.lexical_index.search(query, max(fetchK, k), allowed)
+
+    terms = len(get_terms(query))
+    confident = len(results) > 0 and results[0][2] == terms and (
+        len(results) == 1 or results[0][1] >= lexicalMargin * results[1][1])
+
+    # hits of a few common terms are noise for the fusion
+    docs = [vectorstore.docstore.search(id) for id, _, matched in results if matched >= minLexicalMatch * terms]
+    print(f'lexical: {len(docs)} documents, confident: {confident}')
+
+    return docs, confident
+
+def fetch_from_faiss(vectorstore, query_embedding, fetch_k, allowed):
+    query = np.array([query_embedding], dtype=np.float32)
+    if allowed is None:
+        _, indices = vectorstore.index.search(query, fetch_k)
+        indices = [int(i) for i in indices[0] if i != -1]  # -1 if less than fetch_k documents
+    else:  # exact search over the vectors of the allowed documents, so fetch_k documents are found if exist
+        indices = [i for i, id in vectorstore.index_to_docstore_id.items() if id in allowed]
+        if not indices:
+            return [], []
+        matrix = np.vstack([vectorstore.index.reconstruct(i) for i in indices])
+        distances = np.sum((matrix - query)**2, axis=1)  # l2 of IndexFlatL2
+        indices = [indices[j] for j in np.argsort(distances)[:fetch_k]]
+
+    docs = []
+    vectors = []
+    for i in indices:
+        docs.append(vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]))
+        vectors.append(vectorstore.index.reconstruct(i))
+    
+    return docs, vectors
+
+def fetch_from_opensearch(vectorstore, query_embedding, fetch_k, options):
+    # the filter is applied while searching the graph of lucene, so k documents are found if exist
+    knn = {"vector": query_embedding, "k": max(options['ef_search'], fetch_k)}
+    ids = get_filter_ids(options)
+    conditions = [{"terms": {"_id": ids}}] if ids is not None else []
+    if conditions:
+        knn['filter'] = {"bool": {"filter": conditions}}
+
+    try:
+        response = vectorstore.client.search(
+            index=vectorstore.index_name,
+            body={
+                "size": fetch_k,
+                "query": {"knn": {"vector_field": knn}}
+            }
+        )
+    except Exception as e:
+        if not conditions:
+            raise
+        print('fail to filter in k-NN, filter the results: ', e)  # the indexes of nmslib
+        knn.pop('filter')
+        response = vectorstore.client.search(
+            index=vectorstore.index_name,
+            body={
+                "size": fetch_k,
+                "query": {"bool": {"must": [{"knn": {"vector_field": knn}}], "filter": conditions}}
+            }
+        )
+
+    docs = []
+    vectors = []
+    for hit in response['hits']['hits']:
+        source = hit['_source']
+        docs.append(Document(page_content=source['text'], metadata=source.get('metadata', {})))
+        vectors.append(source['vector_field'])
+    
+    return docs, vectors
+
+def rerank_documents(query_embedding, docs, vectors, k, lambda_mult, min_score):
+    if not docs:
+        return []
+
+    # cosine similarity whatever the distance of the store is
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(np.linalg.norm(query), 1e-10)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-10)
+
+    relevance = matrix @ query
+    candidates = np.flatnonzero(relevance >= min_score)
+    print(f'rerank: {len(candidates)} of {len(docs)} candidates are over the score of {min_score}')
+    if len(candidates) == 0:
+        return []
+    matrix = matrix[candidates]
+    relevance = relevance[candidates]
+
+    # maximal marginal relevance
+    similarity = matrix @ matrix.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult*relevance - (1-lambda_mult)*redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+
+    for i in selected:
+        print(f'score: {relevance[i]:0.3f}, {docs[candidates[i]].page_content[:50]}')
+    return [docs[candidates[i]] for i in selected]
+
+def search_documents(query, vectorstore, k=3):
+    options = get_search_options()
+    k = options['k'] or k
+    hybrid = enableHybridSearch and isinstance(vectorstore, HybridFAISS)
+    if searchType != 'mmr' and not options['filter'] and not hybrid:
+        return vectorstore.similarity_search(query, k=k)
+
+    allowed = None
+    if rag_type == 'faiss' and options['filter']:
+        allowed = get_allowed_ids(vectorstore, options)
+        print(f'filter: {len(allowed)} documents are allowed')
+
+    if hybrid:
+        lexical_docs, confident = search_lexical(query, vectorstore, k, allowed)
+        if confident:  # exact terms, no need to embed the query
+            return lexical_docs[:k]
+
+    query_embedding = embeddings.embed_query(query)
+    if rag_type == 'faiss':
+        docs, vectors = fetch_from_faiss(vectorstore, query_embedding, max(fetchK, k), allowed)
+    elif rag_type == 'opensearch':
+        docs, vectors = fetch_from_opensearch(vectorstore, query_embedding, max(fetchK, k), options)
+
+    if searchType == 'mmr':
+        dense_docs = rerank_documents(query_embedding, docs, vectors, max(fetchK, k), lambdaMult, minRelevanceScore)
+    else:  # already in the order of similarity
+        dense_docs = docs
+
+    if hybrid:
+        return fuse_rankings([dense_docs, lexical_docs], k, [1.0, lexicalWeight])
+
+    return dense_docs[:k]
+
+class RerankRetriever(BaseRetriever):
+    vectorstore: VectorStore
+    k: int = 3
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return search_documents(query, self.vectorstore, self.k)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return search_documents(query, self.vectorstore, self.k)
+
+def get_retriever(vectorstore, config):
+    retriever = RerankRetriever(vectorstore=vectorstore, k=3)
+    if config['enableCompression'] == 'true':
+        retriever = ContextualCompressionRetriever(
+            base_compressor=SentenceCompressor(), 
+            base_retriever=retriever
+        )
+    return retriever
+
 # load csv documents from s3
 def load_csv_document(s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
+    doc = s3.get_object(Bucket=s3_bucket, Key=s3_prefix+'/'+s3_file_name)
 
-    lines = doc.get()['Body'].read().decode('utf-8').split('\n')   # read csv per line
+    lines = doc['Body'].read().decode('utf-8').split('\n')   # read csv per line
     print('lins: ', len(lines))
         
     columns = lines[0].split(',')  # get columns
@@ -202,6 +1036,214 @@ def load_csv_document(s3_file_name):
 
     return docs
 
+def get_chunk_id(userId, content):
+    # content-addressed id, scoped to the user
+    return hashlib.sha256((userId+'\n'+content).encode('utf-8')).hexdigest()
+
+def load_manifest(userId):
+    # returns (manifest, etag)
+    if rag_type == 'faiss':  # faiss is in-memory, so its manifest is too
+        return manifests.get(userId, dict()), None
+
+    # read every time since the other lambda containers may have updated it
+    try:
+        obj = s3.get_object(Bucket=s3_bucket, Key=manifest_prefix+'/'+userId+'.json')
+        return json.loads(obj['Body'].read().decode('utf-8')), obj['ETag']
+    except s3.exceptions.NoSuchKey:
+        print('no manifest for ', userId)
+        return dict(), None
+
+def save_manifest(userId, file_name, entry, manifest, etag):
+    manifest[file_name] = entry
+    if rag_type == 'faiss':
+        manifests[userId] = manifest
+        return
+
+    # conditional write, and merge with the manifest of the other container if it was updated
+    for attempt in range(maxAttempts):
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(
+                Bucket=s3_bucket, 
+                Key=manifest_prefix+'/'+userId+'.json', 
+                Body=json.dumps(manifest).encode('utf-8'),
+                ContentType='application/json',
+                **condition
+            )
+            return
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            print('manifest is updated by another request, merge it')
+            manifest, etag = load_manifest(userId)
+            manifest[file_name] = entry
+
+    raise Exception ("Not able to update the manifest")
+
+def get_chunk_changes(userId, manifest, file_name, docs):
+    # chunks which are already indexed by any file of the user
+    indexed = dict()
+    for name, entry in manifest.items():
+        if name != file_name:
+            indexed.update(entry['chunks'])
+    previous = manifest[file_name]['chunks'] if file_name in manifest else dict()
+    indexed.update(previous)
+
+    chunks = dict()   # chunk id -> index name, None for new chunks
+    new_docs = []
+    new_ids = []
+    for doc in docs:
+        id = get_chunk_id(userId, doc.page_content)
+        if id in chunks:  # duplicated in the same file
+            continue
+        chunks[id] = indexed.get(id)
+        if chunks[id] is None:
+            new_docs.append(doc)
+            new_ids.append(id)
+
+    # removed chunks which no other file refers to
+    referred = set()
+    for name, entry in manifest.items():
+        if name != file_name:
+            referred.update(entry['chunks'].keys())
+    removed = {id: index for id, index in previous.items() if id not in chunks and id not in referred}
+
+    return chunks, new_docs, new_ids, removed
+
+def delete_legacy_chunks(client, userId, file_name, manifest):
+    # chunks indexed before the manifest have random ids, so remove them at the first upload of the file after the migration
+    referred = set()
+    for entry in manifest.values():
+        referred.update(entry['chunks'].keys())
+    try:
+        response = client.delete_by_query(
+            index='rag-index-'+userId+'-*',
+            body={"query": {"bool": {
+                "filter": [{"term": {"metadata.name.keyword": file_name}}],
+                "must_not": [{"ids": {"values": list(referred)}}]
+            }}}
+        )
+        print(f'legacy chunks of {file_name}: {response.get("deleted", 0)} deleted')
+    except Exception as e:
+        print(f'fail to delete legacy chunks of {file_name}: ', e)
+
+def index_documents(userId, requestId, file_name, file_type, upload_time, docs):
+    manifest, etag = load_manifest(userId)
+    chunks, new_docs, new_ids, removed = get_chunk_changes(userId, manifest, file_name, docs)
+    print(f'chunks: {len(chunks)}, new: {len(new_docs)}, removed: {len(removed)}')
+
+    if rag_type == 'faiss':
+        vectorstore = vectorstores.get(userId)
+        if len(new_docs):
+            if vectorstore is None:                    
+                vectorstore = HybridFAISS.from_documents( # create vectorstore from a document
+                    new_docs,  # documents
+                    embeddings,  # embeddings
+                    ids=new_ids
+                )
+                vectorstores[userId] = vectorstore
+            else:                             
+                vectorstore.add_documents(new_docs, ids=new_ids)
+        if len(removed) and vectorstore is not None:
+            vectorstore.delete(list(removed.keys()))
+        if vectorstore is not None:
+            print('vector store size: ', len(vectorstore.docstore._dict))
+        
+        for id in new_ids:
+            chunks[id] = 'faiss'
+
+    elif rag_type == 'opensearch':         
+        index_name = "rag-index-"+userId+'-'+requestId
+        new_vectorstore = get_opensearch(index_name)
+        if file_name not in manifest:
+            delete_legacy_chunks(new_vectorstore.client, userId, file_name, manifest)
+        if len(new_docs):  # lucene supports filtering in k-NN search
+            new_vectorstore.add_documents(new_docs, ids=new_ids, engine='lucene', space_type='l2')    
+        for id, index in removed.items():
+            try:
+                new_vectorstore.client.delete(index=index, id=id)
+            except Exception:
+                print(f'fail to delete {id} in {index}')
+        
+        for id in new_ids:
+            chunks[id] = index_name
+
+    entry = {'type': file_type, 'upload_time': upload_time, 'chunks': chunks}  # for filtering
+    save_manifest(userId, file_name, entry, manifest, etag)
+    if rag_type == 'faiss':
+        save_faiss(userId)
+
+opensearch_store = None  # its client is shared, so the connections are reused by the requests
+
+def get_opensearch(index_name):
+    global opensearch_store
+    with lock:
+        if opensearch_store is None:
+            opensearch_store = OpenSearchVectorSearch(
+                index_name = "rag-index-*",
+                is_aoss = False,
+                embedding_function = embeddings,
+                opensearch_url = opensearch_url,
+                http_auth=(opensearch_account, opensearch_passwd),
+            )
+    vectorstore = copy.copy(opensearch_store)  # the same client for another index
+    vectorstore.index_name = index_name
+    return vectorstore
+
+faiss_files = ['index.faiss', 'index.pkl', 'index.lexical.json']
+
+def save_faiss(userId):
+    # faiss is in memory, so keep a copy in s3 to restore it after the eviction or a cold start
+    folder = os.path.join('/tmp/faiss', userId)
+    key = faiss_prefix+'/'+userId+'/'
+    try:
+        vectorstore = vectorstores.get(userId)
+        if vectorstore is not None:
+            vectorstore.save_local(folder)
+            for name in faiss_files:
+                s3.upload_file(os.path.join(folder, name), s3_bucket, key+name)
+        s3.put_object(  # the manifest is the last, so the files are complete if it exists
+            Bucket=s3_bucket, 
+            Key=key+'manifest.json', 
+            Body=json.dumps(manifests.get(userId, dict())).encode('utf-8'),
+            ContentType='application/json'
+        )
+        unsaved.discard(userId)
+        print('faiss is saved: ', userId)
+        return True
+    except Exception as e:
+        print('fail to save faiss: ', e)
+        unsaved.add(userId)
+        return False
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def get_faiss(userId):
+    # faiss of the user, which is restored from s3 if it was evicted
+    if userId in vectorstores:
+        return vectorstores[userId]
+
+    folder = os.path.join('/tmp/faiss', userId)
+    key = faiss_prefix+'/'+userId+'/'
+    vectorstore = None
+    try:
+        obj = s3.get_object(Bucket=s3_bucket, Key=key+'manifest.json')
+        manifest = json.loads(obj['Body'].read().decode('utf-8'))
+        if any(entry['chunks'] for entry in manifest.values()):  # faiss was created with the first chunk
+            os.makedirs(folder, exist_ok=True)
+            for name in faiss_files:
+                s3.download_file(s3_bucket, key+name, os.path.join(folder, name))
+            vectorstore = HybridFAISS.load_local(folder, embeddings)
+        manifests[userId] = manifest
+        print('faiss is restored: ', userId)
+    except s3.exceptions.NoSuchKey:
+        print('no faiss for ', userId)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    vectorstores[userId] = vectorstore
+    return vectorstore
+
 def get_summary(texts):    
     # check korean
     pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+') 
@@ -240,7 +1282,7 @@ def get_summary(texts):
         # return summary[1:len(summary)-1]   
         return summary
 
-def get_answer_using_template_with_history(query, vectorstore, chat_memory):  
+def get_answer_using_template_with_history(query, vectorstore, chat_memory, config):  
     # check korean
     pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+') 
     word_kor = pattern_hangul.search(str(query))
@@ -288,7 +1330,12 @@ def get_answer_using_template_with_history(query, vectorstore, chat_memory):
         chat_history = ""
     
     # load related docs
-    relevant_documents = vectorstore.similarity_search(query)
+    if vectorstore is not None:
+        relevant_documents = search_documents(query, vectorstore, k=4)
+    else:  # retrieval is skipped by the router
+        relevant_documents = []
+    if config['enableCompression'] == 'true':
+        relevant_documents = compress_documents(query, relevant_documents, maxContextTokens)
     #print('relevant_documents: ', relevant_documents)
 
     print(f'{len(relevant_documents)} documents are fetched which are relevant to the query.')
@@ -311,7 +1358,7 @@ def get_answer_using_template_with_history(query, vectorstore, chat_memory):
     # print('result: ', result)
 
     # add refrence
-    if len(relevant_documents)>=1 and enableReference=='true':
+    if len(relevant_documents)>=1 and config['enableReference']=='true':
         reference = get_reference(relevant_documents)
         # print('reference: ', reference)
 
@@ -359,7 +1406,7 @@ def get_history(history):
     #print('full history: ', msg_history)
     return  msg_history
 
-def get_answer_using_chat_history_and_Llama2_template(query, vectorstore, chat_memory):  
+def get_answer_using_chat_history_and_Llama2_template(query, vectorstore, chat_memory, config):  
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(Llama2_HISTORY_PROMPT)
         
     # extract chat history
@@ -393,7 +1440,12 @@ def get_answer_using_chat_history_and_Llama2_template(query, vectorstore, chat_m
         print('history: ', history)     
 
     # load related docs
-    relevant_documents = vectorstore.similarity_search(query)
+    if vectorstore is not None:
+        relevant_documents = search_documents(query, vectorstore, k=4)
+    else:  # retrieval is skipped by the router
+        relevant_documents = []
+    if config['enableCompression'] == 'true':
+        relevant_documents = compress_documents(query, relevant_documents, maxContextTokens)
     #print('relevant_documents: ', relevant_documents)
 
     relevant_txt = ""
@@ -440,9 +1492,7 @@ def _get_chat_history(chat_history):
             )
     return buffer
 
-memory_chain = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-
-def create_ConversationalRetrievalChain(vectorstore):  
+def create_ConversationalRetrievalChain(vectorstore, config):  
     #condense_template = """Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer.
     
     #{chat_history}
@@ -484,13 +1534,11 @@ def create_ConversationalRetrievalChain(vectorstore):
     
     qa = ConversationalRetrievalChain.from_llm(
         llm=llm, 
-        retriever=vectorstore.as_retriever(
-            search_type="similarity", search_kwargs={"k": 3}
-        ),         
+        retriever=get_retriever(vectorstore, config),         
         condense_question_prompt=CONDENSE_QUESTION_PROMPT, # chat history and new question
         #combine_docs_chain_kwargs={'prompt': qa_prompt_template},  
 
-        memory=memory_chain,
+        memory=ConversationBufferMemory(memory_key="chat_history", return_messages=True),
         get_chat_history=_get_chat_history,
         verbose=False, # for logging to stdout
         
@@ -507,11 +1555,7 @@ def create_ConversationalRetrievalChain(vectorstore):
 def get_answer_using_query(query, vectorstore, rag_type):
     wrapper_store = VectorStoreIndexWrapper(vectorstore=vectorstore)
     
-    if rag_type == 'faiss':
-        query_embedding = vectorstore.embedding_function(query)
-        relevant_documents = vectorstore.similarity_search_by_vector(query_embedding)
-    elif rag_type == 'opensearch':
-        relevant_documents = vectorstore.similarity_search(query)
+    relevant_documents = search_documents(query, vectorstore, k=3)
     
     print(f'{len(relevant_documents)} documents are fetched which are relevant to the query.')
     print('----')
@@ -524,7 +1568,7 @@ def get_answer_using_query(query, vectorstore, rag_type):
 
     return answer
 
-def get_answer_using_template(query, vectorstore, rag_type):        
+def get_answer_using_template(query, vectorstore, rag_type, config):        
     #summarized_query = summerize_text(query)        
     #    if rag_type == 'faiss':
     #        query_embedding = vectorstore.embedding_function(summarized_query)
@@ -532,11 +1576,9 @@ def get_answer_using_template(query, vectorstore, rag_type):
     #    elif rag_type == 'opensearch':
     #        relevant_documents = vectorstore.similarity_search(summarized_query)
     
-    if rag_type == 'faiss':
-        query_embedding = vectorstore.embedding_function(query)
-        relevant_documents = vectorstore.similarity_search_by_vector(query_embedding)
-    elif rag_type == 'opensearch':
-        relevant_documents = vectorstore.similarity_search(query)
+    relevant_documents = search_documents(query, vectorstore, k=3)
+    if config['enableCompression'] == 'true':
+        relevant_documents = compress_documents(query, relevant_documents, maxContextTokens)
 
     print(f'{len(relevant_documents)} documents are fetched which are relevant to the query.')
     print('----')
@@ -572,27 +1614,65 @@ def get_answer_using_template(query, vectorstore, rag_type):
         template=prompt_template, input_variables=["context", "question"]
     )
 
-    qa = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=vectorstore.as_retriever(
-            search_type="similarity", search_kwargs={"k": 3}
-        ),
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": PROMPT}
-    )
-    result = qa({"query": query})
+    # use the documents which are already retrieved
+    qa = load_qa_chain(llm=llm, chain_type="stuff", prompt=PROMPT)
+    result = qa({"input_documents": relevant_documents, "question": query})
     print('result: ', result)
-    source_documents = result['source_documents']
-    print('source_documents: ', source_documents)
 
-    if len(relevant_documents)>=1 and enableReference=='true':
-        reference = get_reference(source_documents)
+    if len(relevant_documents)>=1 and config['enableReference']=='true':
+        reference = get_reference(relevant_documents)
         #print('reference: ', reference)
 
-        return result['result']+reference
+        return result['output_text']+reference
+    else:
+        return result['output_text']
+
+# queries which don't need documents
+pattern_smalltalk = re.compile(
+    r'(hi|hello|hey|thanks|thank you|ok|okay|good|great|bye|yes|no|sure|'
+    r'안녕|안녕하세요|고마워|고마워요|감사|감사합니다|네|응|아니|아니요|좋아요|알겠어|알겠습니다|잘가)',
+    re.IGNORECASE)
+pattern_followup = re.compile(
+    r'(tell me more|more details?|explain (it|that|more)|continue|go on|say (it |that )?again|'
+    r'translate (it|that)( into \w+)?|what do you mean|더 자세히.*|다시 설명.*|계속.*|번역해.*)',
+    re.IGNORECASE)
+
+routing_stats = {
+    'queries': 0,
+    'retrievals': 0,
+    'skipped': 0,
+    'saved_tokens': 0,
+}
+
+def get_context_tokens(config):
+    # prompt tokens of the relevant documents which the answer of the current settings would have
+    conversation = config['enableConversationMode'] == 'true'
+    k = get_search_options()['k'] or (4 if conversation and methodOfConversation == 'PromptTemplate' else 3)
+    tokens = k*1000//4  # chunks of 1000 characters, about 4 characters per token
+    if config['enableCompression'] == 'true':
+        tokens = min(tokens, maxContextTokens)
+    return tokens
+
+def need_retrieval(query, config):
+    conversation = config['enableConversationMode'] == 'true'
+    text = query.strip().rstrip('.!?~ ')
+    if pattern_smalltalk.fullmatch(text):
+        retrieval = False
+    elif conversation and pattern_followup.fullmatch(text):  # answered by chat history
+        retrieval = False
     else:
-        return result['result']
+        retrieval = True
+
+    with stats_lock:
+        routing_stats['queries'] += 1
+        if retrieval:
+            routing_stats['retrievals'] += 1
+        else:
+            routing_stats['skipped'] += 1
+            routing_stats['saved_tokens'] += get_context_tokens(config)
+    print('need_retrieval: ', retrieval)
+    
+    return retrieval
 
 def get_reference(docs):
     reference = "\n\nFrom\n"
@@ -604,8 +1684,6 @@ def get_reference(docs):
     return reference
 
 def load_chatHistory(userId, allowTime, chat_memory):
-    dynamodb_client = boto3.client('dynamodb')
-
     response = dynamodb_client.query(
         TableName=callLogTableName,
         KeyConditionExpression='user_id = :userId AND request_time > :allowTime',
@@ -647,31 +1725,52 @@ def lambda_handler(event, context):
     body = event['body']
     print('body: ', body)
 
-    global llm, vectorstore, isReady, map, qa
-    global enableConversationMode, enableReference, enableRAG  # debug
-    
-    # memory for conversation
-    if userId in map:
-        chat_memory = map[userId]
-        print('chat_memory exist. reuse it!')
-    else: 
-        chat_memory = ConversationBufferMemory(human_prefix='User', ai_prefix='Assistant')
-        map[userId] = chat_memory
-        print('chat_memory does not exist. create new one!')
+    set_deadline(context)
+    set_search_options(event)
+    start = int(time.time())    
+
+    user_lock = acquire_lock(userId)
+    try:
+        msg = get_response(userId, requestId, requestTime, type, body)
+    finally:
+        user_lock.release()
+    evict_users()
+                
+    elapsed_time = int(time.time()) - start
+    print("total run time(sec): ", elapsed_time)
+
+    print('msg: ', msg)
+
+    item = {
+        'user_id': {'S':userId},
+        'request_id': {'S':requestId},
+        'request_time': {'S':requestTime},
+        'type': {'S':type},
+        'body': {'S':body},
+        'msg': {'S':msg}
+    }
+
+    try:
+        resp =  dynamodb_client.put_item(TableName=callLogTableName, Item=item)
+    except: 
+        raise Exception ("Not able to write into dynamodb")
+        
+    print('resp, ', resp)
+
+    return {
+        'statusCode': 200,
+        'msg': msg,
+    }
+
+def get_response(userId, requestId, requestTime, type, body):
+    config = get_config(userId)
+    chat_memory = get_chat_memory(userId)  # memory for conversation
     
     if rag_type == 'opensearch':
-        vectorstore = OpenSearchVectorSearch(
-            # index_name = "rag-index-*", // all
-            index_name = 'rag-index-'+userId+'-*',
-            is_aoss = False,
-            embedding_function = embeddings,
-            opensearch_url=opensearch_url,
-            http_auth=(opensearch_account, opensearch_passwd),
-        )
+        vectorstore = get_opensearch('rag-index-'+userId+'-*')
     elif rag_type == 'faiss':
-        print('isReady = ', isReady)
-   
-    start = int(time.time())    
+        vectorstore = get_faiss(userId)
+        print('isReady = ', vectorstore is not None)
 
     msg = ""
     
@@ -680,39 +1779,54 @@ def lambda_handler(event, context):
 
         # debugging
         if text == 'enableReference':
-            enableReference = 'true'
+            config['enableReference'] = 'true'
             msg  = "Referece is enabled"
         elif text == 'disableReference':
-            enableReference = 'false'
+            config['enableReference'] = 'false'
             msg  = "Reference is disabled"
         elif text == 'enableConversationMode':
-            enableConversationMode = 'true'
+            config['enableConversationMode'] = 'true'
             msg  = "Conversation mode is enabled"
         elif text == 'disableConversationMode':
-            enableConversationMode = 'false'
+            config['enableConversationMode'] = 'false'
             msg  = "Conversation mode is disabled"
         elif text == 'enableRAG':
-            enableRAG = 'true'
+            config['enableRAG'] = 'true'
             msg  = "RAG is enabled"
         elif text == 'disableRAG':
-            enableRAG = 'false'
+            config['enableRAG'] = 'false'
             msg  = "RAG is disabled"
+        elif text == 'enableCompression':
+            config['enableCompression'] = 'true'
+            msg  = "Compression is enabled"
+        elif text == 'disableCompression':
+            config['enableCompression'] = 'false'
+            msg  = "Compression is disabled"
+        elif text == 'routingStats':
+            msg  = json.dumps(routing_stats)
+        elif text == 'compressionStats':
+            msg  = json.dumps(compression_stats)
+        elif text == 'invocationStats':
+            msg  = json.dumps(invocation_stats)
         else:
 
-            if rag_type == 'faiss' and isReady == False: 
+            if rag_type == 'faiss' and vectorstore is None: 
                 msg = llm(text)
             else: 
                 querySize = len(text)
                 textCount = len(text.split())
                 print(f"query size: {querySize}, workds: {textCount}")
                 
-                if querySize<1800 and enableRAG=='true': # max 1985
-                    if enableConversationMode == 'true':
+                if querySize<1800 and config['enableRAG']=='true': # max 1985
+                    retrieval = need_retrieval(text, config)
+
+                    if config['enableConversationMode'] == 'true':
                         if methodOfConversation == 'PromptTemplate':                            
+                            store = vectorstore if retrieval else None
                             if typeOfHistoryTemplate == "Llama2":
-                                msg = get_answer_using_chat_history_and_Llama2_template(text, vectorstore, chat_memory)
+                                msg = get_answer_using_chat_history_and_Llama2_template(text, store, chat_memory, config)
                             else:
-                                msg = get_answer_using_template_with_history(text, vectorstore, chat_memory)
+                                msg = get_answer_using_template_with_history(text, store, chat_memory, config)
                                                               
                             storedMsg = str(msg).replace("\n"," ") 
                             chat_memory.save_context({"input": text}, {"output": storedMsg})   
@@ -720,21 +1834,27 @@ def lambda_handler(event, context):
                             allowTime = getAllowTime()
                             load_chatHistory(userId, allowTime, chat_memory)               
                         else: # ConversationalRetrievalChain
-                            if isReady==False:
-                                isReady = True
-                                qa = create_ConversationalRetrievalChain(vectorstore)
+                            if userId not in chains:
+                                chains[userId] = create_ConversationalRetrievalChain(vectorstore, config)
+                            qa = chains[userId]
 
-                            result = qa(text)
-                            print('result: ', result)    
-                            msg = result['answer']
+                            if retrieval==False: # without documents
+                                msg = llm(HUMAN_PROMPT+text+AI_PROMPT)
+                                qa.memory.save_context({"input": text}, {"output": msg})
+                            else:
+                                result = qa(text)
+                                print('result: ', result)    
+                                msg = result['answer']
 
                             # extract chat history
-                            chats = memory_chain.load_memory_variables({})
+                            chats = qa.memory.load_memory_variables({})
                             chat_history_all = chats['chat_history']
                             print('chat_history_all: ', chat_history_all)
                             
+                    elif retrieval:
+                        msg = get_answer_using_template(text, vectorstore, rag_type, config)  # using template   
                     else:
-                        msg = get_answer_using_template(text, vectorstore, rag_type)  # using template   
+                        msg = llm(HUMAN_PROMPT+text+AI_PROMPT)
                 else:
                     msg = llm(HUMAN_PROMPT+text+AI_PROMPT)
             
@@ -769,54 +1889,10 @@ def lambda_handler(event, context):
                 )        
             print('docs[0]: ', docs[0])    
             print('docs size: ', len(docs))
-            
-        if rag_type == 'faiss':
-            if isReady == False:                    
-                vectorstore = FAISS.from_documents( # create vectorstore from a document
-                    docs,  # documents
-                    embeddings  # embeddings
-                )
-                isReady = True                    
-            else:                             
-                vectorstore.add_documents(docs)
-                print('vector store size: ', len(vectorstore.docstore._dict))
 
-        elif rag_type == 'opensearch':         
-            new_vectorstore = OpenSearchVectorSearch(
-                index_name="rag-index-"+userId+'-'+requestId,
-                is_aoss = False,
-                embedding_function = embeddings,
-                opensearch_url = opensearch_url,
-                http_auth=(opensearch_account, opensearch_passwd),
-            )
-            new_vectorstore.add_documents(docs)    
+        index_documents(userId, requestId, object, file_type, requestTime, docs)
         
         # summerize the document
         msg = get_summary(texts)
-                
-    elapsed_time = int(time.time()) - start
-    print("total run time(sec): ", elapsed_time)
-
-    print('msg: ', msg)
 
-    item = {
-        'user_id': {'S':userId},
-        'request_id': {'S':requestId},
-        'request_time': {'S':requestTime},
-        'type': {'S':type},
-        'body': {'S':body},
-        'msg': {'S':msg}
-    }
-
-    client = boto3.client('dynamodb')
-    try:
-        resp =  client.put_item(TableName=callLogTableName, Item=item)
-    except: 
-        raise Exception ("Not able to write into dynamodb")
-        
-    print('resp, ', resp)
-
-    return {
-        'statusCode': 200,
-        'msg': msg,
-    }
+    return msg
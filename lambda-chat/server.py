@@ -0,0 +1,83 @@
+# HTTP front end to serve lambda_handler from a container with many requests in one process
+# docker run -p 8080:8080 --entrypoint python3 <image> server.py
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from lambda_function import lambda_handler
+
+port = int(os.environ.get('port', '8080'))
+workers = int(os.environ.get('workers', '8'))
+timeout = int(os.environ.get('timeout', '10'))  # seconds to wait for the request of a connection
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    # one request per connection, so that idle keep-alive connections don't hold the workers
+    protocol_version = 'HTTP/1.1'
+    timeout = timeout
+
+    def send_json(self, status, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'msg': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/chat':
+            self.send_json(404, {'msg': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            event = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self.send_json(400, {'msg': 'invalid request'})
+            return
+
+        try:
+            result = lambda_handler(event, None)
+            self.send_json(result['statusCode'], result)
+        except Exception as e:
+            print('error: ', e)
+            self.send_json(500, {'statusCode': 500, 'msg': str(e)})
+
+class PooledHTTPServer(HTTPServer):
+    # serve requests with a fixed number of worker threads
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+def main():
+    server = PooledHTTPServer(('0.0.0.0', port), ChatRequestHandler, workers)
+    print(f'serving on port {port} with {workers} workers')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()